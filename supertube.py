@@ -5,19 +5,45 @@ SuperTube:
 一个神奇的数据迁移工具
 """
 
+import io
 import sys
 import os
+import time
+import keyword
 import logging
+import operator
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
 
 from django.db import transaction
 from django.core.management.color import no_style
-from django.db import connection
-from django.db.models import Model, ForeignKey
+from django.db import connection, connections, router
+from django.db.models import Model, ForeignKey, FileField, Min, Max, signals
+from django.db.models.base import ModelState
+
+try:
+    from psycopg2.extras import execute_values
+except ImportError:
+    execute_values = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 logger = logging.getLogger(__name__)
 
 
+_BAR_LEN = 60
+# every bar is a slice of this, no string building per redraw
+_BAR = '=' * _BAR_LEN + '-' * _BAR_LEN
+_SPINNER = '|/-\\'
+
+
 def progress(count, total, status=''):
     """
     模拟进度条
@@ -31,15 +57,61 @@ def progress(count, total, status=''):
     >>     time.sleep(0.05)  # emulating long-playing job
     >>     i += 10
     [===========================================================-] 99.0% ...Doing very long job
+
+    total 为 None（总数还不知道）时显示转圈和已完成的行数。
     """
-    bar_len = 60
-    filled_len = int(round(bar_len * count / float(total)))
+    if not total:
+        spinner = _SPINNER[int(time.monotonic() * 10) % len(_SPINNER)]
+        sys.stdout.write('%s:[%s] %s rows\r' % (status, spinner, count))
+        sys.stdout.flush()
+        return
+    count = min(count, total)
+    filled_len = _BAR_LEN * count // total
+    percents = (1000 * count // total) / 10
+    bar = _BAR[_BAR_LEN - filled_len:2 * _BAR_LEN - filled_len]
+
+    sys.stdout.write('%s:[%s] %s%%\r' % (status, bar, percents))
+    sys.stdout.flush()
 
-    percents = round(100.0 * count / float(total), 1)
-    bar = '=' * filled_len + '-' * (bar_len - filled_len)
 
-    sys.stdout.write('%s:[%s] %s%s\r' % (status, bar, percents, '%'))
-    sys.stdout.flush()
+# field types whose prepared values _copy_text writes correctly. Arrays, hstore, ranges,
+# intervals, inet etc. need their own text formats, such tables fall back to bulk_create on psycopg2
+_COPY_TEXT_TYPES = frozenset([
+    'AutoField', 'BigAutoField', 'SmallAutoField', 'BooleanField', 'NullBooleanField',
+    'CharField', 'TextField', 'SlugField', 'EmailField', 'URLField', 'FilePathField', 'FileField',
+    'IntegerField', 'BigIntegerField', 'SmallIntegerField', 'PositiveIntegerField',
+    'PositiveBigIntegerField', 'PositiveSmallIntegerField', 'FloatField', 'DecimalField',
+    'DateField', 'DateTimeField', 'TimeField', 'UUIDField', 'BinaryField', 'JSONField',
+])
+_COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def _copy_text(value):
+    """
+    把一个已经过 get_db_prep_save 的值转成 COPY text 格式的一列
+    """
+    if hasattr(value, 'adapted'):
+        # psycopg2 adapters returned by get_db_prep_save, e.g. Json and Binary
+        value = value.dumps(value.adapted) if hasattr(value, 'dumps') else value.adapted
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\\\x' + bytes(value).hex()
+    if hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    return str(value).translate(_COPY_ESCAPES)
+
+
+def _has_integer_pk(model):
+    return model._meta.pk.get_internal_type().endswith(('AutoField', 'IntegerField'))
+
+
+def _attr_expr(obj_name, attr):
+    if attr.isidentifier() and not keyword.iskeyword(attr):
+        return '%s.%s' % (obj_name, attr)
+    return '_getattr(%s, %r)' % (obj_name, attr)
 
 
 class SuperTube(object):
@@ -72,12 +144,30 @@ class SuperTube(object):
     >> st.result
     True
     """
+    PROGRESS_INTERVAL = 0.1
+    # seconds to wait for the background COUNT(*) before the finish message
+    COUNT_WAIT = 1.0
+    # upper bound of the automatic batch_size per destination backend
+    VENDOR_BATCH_SIZE = {'postgresql': 1000, 'mysql': 100000}
+
     def __init__(self, source, dest, filter=None, **kwargs):
         """
 
         :param source: django model
         :param dest: django model
-        :param kwargs: set default, custom mapping
+        :param kwargs: set default, custom mapping, source_db, source_chunk_size,
+            keyset_pagination (None means use it when source pk is an integer),
+            fast_unsafe_construct (build dest objects without Model.__init__, no
+            pre_init/post_init signals),
+            vectorized_mapping (see below)
+
+        vectorized_mapping 的函数每批只调用一次，参数是这一批源数据某一列的 ndarray，
+        返回同样长度的 ndarray，比如 {'age': lambda arr: arr + 1}。源属性取 mapping 中同名字段
+        对应的字符串，没有则取同名属性。函数必须逐元素计算（第 i 个结果只依赖第 i 个值），
+        这些字段不经过 build_obj。需要安装 numpy。
+        这一列含 None（可为空的字段）或其他非数值时得到 object 数组，不整列调用，改为每行单独
+        调用一次（参数是长度为 1 的 ndarray），函数处理不了 None 的行和其他出错的行一样，
+        run(skip=True) 时记录日志并跳过，否则抛出异常。整列调用出错时也按同样方式逐行重试。
         """
         if not (issubclass(source, Model) and issubclass(dest, Model)):
             raise ValueError('source and dest must be subclass of django.db.models.Model')
@@ -88,18 +178,82 @@ class SuperTube(object):
         self.dest = dest
         self.custom_mapping = kwargs.get('mapping', {})
         self.defaults = kwargs.get('defaults', {})
+        self.fast_unsafe_construct = kwargs.get('fast_unsafe_construct', False)
+        self.vectorized_mapping = kwargs.get('vectorized_mapping', {})
+        if self.vectorized_mapping and np is None:
+            raise ValueError('vectorized_mapping requires numpy.')
+        if self.fast_unsafe_construct:
+            logger.warning('fast_unsafe_construct is on for %s: Model.__init__ is bypassed, '
+                           'pre_init/post_init signals will NOT be sent.', dest._meta.label)
         self.source_db = kwargs.get('source_db', 'default')
+        self.dest_db = router.db_for_write(dest)
+        self.source_chunk_size = kwargs.get('source_chunk_size')
+        self.keyset_pagination = kwargs.get('keyset_pagination')
+        if self.keyset_pagination is None:
+            self.keyset_pagination = _has_integer_pk(source)
 
         if filter:
             self.source_qs = source.objects.using(self.source_db).filter(**filter)
         else:
             self.source_qs = source.objects.using(self.source_db).all()
 
-        self.total_cnt = self.source_qs.count()
-        self.source_qs = self.source_qs.iterator()
+        # filled in by a background count started from run(), None until it finishes
+        self.total_cnt = None
+        self._count_thread = None
         self.succeed_cnt = 0
+        self._cnt_lock = threading.Lock()
+        self._last_progress_ts = 0.0
         self.__setup_fields()
+        self.__setup_insert()
         self.__setup_mapping()
+        if self.source_only_fields:
+            self.source_qs = self.source_qs.only(*self.source_only_fields)
+
+    def _count_async(self):
+        """
+        在后台线程里 count 源数据，迁移不用等 COUNT(*) 扫完全表就能开始
+        """
+        def count():
+            try:
+                self.total_cnt = self.source_qs.count()
+            except Exception as e:
+                logger.warning('count %s failed: %s', self.source._meta.object_name, str(e))
+            finally:
+                connections.close_all()
+
+        if self.total_cnt is None and self._count_thread is None:
+            self._count_thread = threading.Thread(target=count, daemon=True)
+            self._count_thread.start()
+
+    def _keyset_iter(self, qs, chunk_size):
+        """
+        按 pk 分页读取源数据，每次只查 chunk_size 行，不需要长期占用服务端游标。
+        """
+        qs = qs.order_by('pk')
+        chunk = list(qs[:chunk_size])
+        while chunk:
+            for row in chunk:
+                yield row
+            last_pk = chunk[-1].pk
+            chunk = list(qs.filter(pk__gt=last_pk)[:chunk_size])
+
+    def iter_source(self, chunk_size, qs=None):
+        if qs is None:
+            qs = self.source_qs
+        if self.keyset_pagination:
+            return self._keyset_iter(qs, chunk_size)
+        return qs.iterator(chunk_size=chunk_size)
+
+    def _pk_ranges(self, n):
+        """
+        把源表按 pk 切成 n 段左闭右开的区间，pk 必须是整数。
+        """
+        agg = self.source_qs.aggregate(min_pk=Min('pk'), max_pk=Max('pk'))
+        min_pk, max_pk = agg['min_pk'], agg['max_pk']
+        if min_pk is None:
+            return []
+        step = max(1, -(-(max_pk - min_pk + 1) // n))
+        return [(lo, min(lo + step, max_pk + 1)) for lo in range(min_pk, max_pk + 1, step)]
 
     @staticmethod
     def get_field_name(field):
@@ -109,9 +263,26 @@ class SuperTube(object):
             return field.name
 
     def __setup_fields(self):
-        sf = self.source_fields = set([SuperTube.get_field_name(field) for field in self.source._meta.fields])
-        df = self.dest_fields = set([SuperTube.get_field_name(field) for field in self.dest._meta.fields])
-        self.intersection_fields = sf & df
+        # dicts keep _meta.concrete_fields order, so the INSERT column order is stable across processes
+        sf = self.source_fields = {SuperTube.get_field_name(field): None for field in self.source._meta.concrete_fields}
+        df = self.dest_fields = {SuperTube.get_field_name(field): None for field in self.dest._meta.concrete_fields}
+        self.intersection_fields = [field for field in df if field in sf]
+
+    def __setup_insert(self):
+        """
+        use_cursor 用的 INSERT 语句，auto pk 为空的行不写 pk 列，和 bulk_create 一样。
+        """
+        opts = self.dest._meta
+        quote_name = connections[self.dest_db].ops.quote_name
+        self._insert_fields = tuple(opts.local_concrete_fields)
+        self._insert_pk_index = None
+        if opts.auto_field is not None and opts.auto_field in self._insert_fields:
+            self._insert_pk_index = self._insert_fields.index(opts.auto_field)
+        without_pk = tuple(f for f in self._insert_fields if f is not opts.auto_field)
+        self._insert_sql = {}
+        for has_pk, fields in ((True, self._insert_fields), (False, without_pk)):
+            self._insert_sql[has_pk] = (fields, 'INSERT INTO %s (%s)' % (
+                quote_name(opts.db_table), ', '.join(quote_name(f.column) for f in fields)))
 
     def __setup_mapping(self):
         mapping = {}
@@ -120,81 +291,520 @@ class SuperTube(object):
         for k, v in self.custom_mapping.items():
             mapping[k] = v
 
-        self.mapping = mapping
+        # vectorized fields are filled per batch in run(), read from the source
+        # attribute the plain mapping would have used
+        self._vectorized = {}
+        for field, func in self.vectorized_mapping.items():
+            source_attr = mapping.pop(field, field)
+            if not isinstance(source_attr, str):
+                raise ValueError('vectorized field %s must map to a source attribute name.' % field)
+            self._vectorized[field] = (source_attr, func)
 
-    def build_obj(self, old_obj):
-        obj_data = {}
-        for field, old_field in self.mapping.items():
+        self.mapping = mapping
+        self.source_only_fields = self.__get_only_fields()
+        # subclasses overriding build_obj can still reach it through super().build_obj
+        self._build_obj = self.__compile_build_obj()
+        if type(self).build_obj is SuperTube.build_obj:
+            self.build_obj = self._build_obj
+        self.build_row = self.__compile_build_row()
+
+    def __get_only_fields(self):
+        """
+        mapping 只引用源表字段时，只查询用到的列；有 callable 或子类重写了 build_obj 时
+        无法判断会访问哪些属性，查全部列，避免每行一次延迟加载。
+        """
+        if type(self).build_obj is not SuperTube.build_obj or any(callable(v) for v in self.mapping.values()):
+            return None
+        # mapping values are attnames (e.g. ``batch_id``), only() wants field names
+        names = {field.attname: field.name for field in self.source._meta.concrete_fields}
+        names.update((field.name, field.name) for field in self.source._meta.concrete_fields)
+        only_fields = []
+        for v in list(self.mapping.values()) + [attr for attr, func in self._vectorized.values()]:
+            if not isinstance(v, str):
+                continue
+            if v not in names:
+                return None
+            only_fields.append(names[v])
+        return sorted(set(only_fields))
+
+    def __field_exprs(self, namespace, complete=False):
+        """
+        生成 mapping 中每个字段的取值表达式，引用的对象放进 namespace。
+        complete 为 True 时补齐 dest 其余的 concrete 字段（取字段默认值），结果和 Model.__init__ 一致。
+        """
+        values = {}
+        for i, (field, old_field) in enumerate(self.mapping.items()):
             if callable(old_field):
-                func = old_field
-                obj_data[field] = func(old_obj)
+                namespace['_cb%d' % i] = old_field
+                expr = '_cb%d(old_obj)' % i
+            elif isinstance(old_field, str):
+                expr = _attr_expr('old_obj', old_field)
             else:
-                obj_data[field] = getattr(old_obj, old_field)
-        obj = self.dest(**obj_data)
+                namespace['_v%d' % i] = old_field
+                expr = '_v%d' % i
+            if field in self.defaults:
+                namespace['_d%d' % i] = self.defaults[field]
+                expr = '%s or _d%d' % (expr, i)
+            values[field] = expr
+
+        if complete:
+            for i, f in enumerate(self.dest._meta.concrete_fields):
+                if f.attname in values:
+                    continue
+                namespace['_gd%d' % i] = f.get_default
+                expr = '_gd%d()' % i
+                if f.attname in self.defaults:
+                    namespace['_fd%d' % i] = self.defaults[f.attname]
+                    expr = '%s or _fd%d' % (expr, i)
+                values[f.attname] = expr
+        return values
+
+    def __compile(self, name, lines, namespace):
+        # bind everything as default arguments so lookups inside are LOAD_FAST
+        args = ['old_obj'] + ['%s=%s' % (key, key) for key in namespace]
+        code = 'def %s(%s):\n%s\n' % (name, ', '.join(args), '\n'.join(lines))
+        exec(compile(code, '<supertube %s>' % self.dest._meta.label, 'exec'), namespace)
+        return namespace[name]
+
+    def __compile_build_obj(self):
+        """
+        mapping 和 defaults 初始化后不再变化，生成一个展开后的 build_obj，
+        省掉每行每个字段的 callable 判断和 getattr。SuperTube.build_obj 直接调用它。
+        fast_unsafe_construct 开启时不调用 Model.__init__，直接填充实例的 __dict__。
+        """
+        namespace = {'_dest': self.dest, '_getattr': getattr}
+        fast = self.fast_unsafe_construct
+        if fast and not set(self.mapping) <= {f.attname for f in self.dest._meta.concrete_fields}:
+            logger.warning('fast_unsafe_construct disabled for %s: mapping has keys that are not field attnames.',
+                           self.dest._meta.label)
+            fast = False
+        values = self.__field_exprs(namespace, complete=fast)
+        if fast:
+            # everything Model.__init__ would set: a fresh ModelState and every concrete attname
+            namespace.update(_new=self.dest.__new__, _state=ModelState)
+            lines = ['    obj = _new(_dest)',
+                     "    obj.__dict__ = {'_state': _state(), %s}" %
+                     ', '.join('%r: %s' % item for item in values.items())]
+        else:
+            lines = ['    obj = _dest(**{%s})' % ', '.join('%r: %s' % item for item in values.items())]
+
+        for i, (field, value) in enumerate(self.defaults.items()):
+            if field in values:
+                continue
+            namespace['_od%d' % i] = value
+            lines.append('    if not _getattr(obj, %r, None):' % field)
+            lines.append('        setattr(obj, %r, _od%d)' % (field, i))
+        lines.append('    return obj')
+        return self.__compile('build_obj', lines, namespace)
+
+    def __compile_build_row(self):
+        """
+        生成 build_row：直接返回按 _insert_fields 排列的一行值，不创建 dest 实例，给 use_cursor 用。
+        字段的 pre_save、pre_init/post_init 信号会被跳过，所以遇到 auto_now、FileField、
+        信号接收者，或 mapping/defaults 中有不是字段的 key 时返回 None，只能走 ORM。
+        """
+        opts = self.dest._meta
+        attnames = {f.attname for f in opts.concrete_fields}
+        if (len(opts.concrete_fields) != len(opts.local_concrete_fields)
+                or not set(self.mapping) <= attnames or not set(self.defaults) <= attnames
+                or not set(self._vectorized) <= attnames
+                or any(getattr(f, 'auto_now', False) or getattr(f, 'auto_now_add', False)
+                       or isinstance(f, FileField) for f in opts.concrete_fields)
+                or signals.pre_init.has_listeners(self.dest) or signals.post_init.has_listeners(self.dest)):
+            return None
+        namespace = {'_getattr': getattr}
+        values = self.__field_exprs(namespace, complete=True)
+        lines = ['    return (%s,)' % ', '.join(values[f.attname] for f in self._insert_fields)]
+        return self.__compile('build_row', lines, namespace)
 
-        for field, value in self.defaults.items():
-            if not (hasattr(obj, field) and getattr(obj, field)):
-                setattr(obj, field, value)
+    def build_obj(self, old_obj):
+        return self._build_obj(old_obj)
 
-        return obj
+    @contextmanager
+    def _atomic(self, enabled=True):
+        if enabled:
+            with transaction.atomic(using=self.dest_db):
+                yield
+        else:
+            yield
 
-    @transaction.atomic()
-    def run(self, batch_size=1000, check_foreignkey=True, stop_on_error=True, dry_run=False, skip=True):
+    def _copy(self, objs):
         """
-        :param batch_size: integer bulk size.
-        :param check_foreignkey: A boolean flag.
-        :param stop_on_error: A boolean flag.
-        :return:
+        用 COPY ... FROM STDIN 写入一批数据，只支持 PostgreSQL。
+        和 bulk_create 一样，pk 为空的对象不写 pk 列，由数据库自增生成。
         """
-        # TODO check_foreignkey
-        # TODO stop_on_error
+        conn = connections[self.dest_db]
+        opts = self.dest._meta
+        with_pk = [obj for obj in objs if obj.pk is not None]
+        without_pk = [obj for obj in objs if obj.pk is None]
+        with conn.cursor() as cursor:
+            for batch in (with_pk, without_pk):
+                if not batch:
+                    continue
+                fields = [f for f in opts.local_concrete_fields
+                          if batch is with_pk or f is not opts.auto_field]
+                sql = 'COPY %s (%s) FROM STDIN' % (
+                    conn.ops.quote_name(opts.db_table),
+                    ', '.join(conn.ops.quote_name(f.column) for f in fields))
+                rows = ([f.get_db_prep_save(f.pre_save(obj, True), connection=conn) for f in fields]
+                        for obj in batch)
+                raw = cursor.cursor
+                if hasattr(raw, 'copy'):
+                    # psycopg 3
+                    with raw.copy(sql) as copy:
+                        for row in rows:
+                            copy.write_row(row)
+                else:
+                    # psycopg2
+                    data = io.StringIO()
+                    for row in rows:
+                        data.write('\t'.join([_copy_text(v) for v in row]))
+                        data.write('\n')
+                    data.seek(0)
+                    raw.copy_expert(sql, data)
+
+    @contextmanager
+    def _relax_destination(self, enabled=True):
+        """
+        迁移期间删掉 dest 表上的普通索引、禁用用户触发器，结束后一次性重建索引、恢复触发器。
+        主键、唯一索引和约束背后的索引保留，冲突检测不受影响。只支持 PostgreSQL。
+        """
+        conn = connections[self.dest_db]
+        if not enabled:
+            yield
+            return
+        if conn.vendor != 'postgresql':
+            logger.warning('rebuild_indexes is only supported on postgresql, ignored.')
+            yield
+            return
 
-        if not self.total_cnt:
-            print('\n\nmigrate to %s finished: %s of %s succeed.' %
-                  (self.source._meta.object_name, self.succeed_cnt, self.total_cnt))
+        table = conn.ops.quote_name(self.dest._meta.db_table)
+        # postgresql DDL is transactional: if any drop or the ALTER fails, every index is still there
+        with transaction.atomic(using=self.dest_db), conn.cursor() as cursor:
+            # indexrelid::regclass is schema-qualified when the index is outside search_path
+            cursor.execute(
+                'SELECT ix.indexrelid::regclass::text, pg_get_indexdef(ix.indexrelid) FROM pg_index ix '
+                'WHERE ix.indrelid = %s::regclass AND NOT ix.indisprimary AND NOT ix.indisunique '
+                'AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = ix.indexrelid)',
+                [table])
+            indexes = cursor.fetchall()
+            for name, indexdef in indexes:
+                logger.warning('drop index %s, will recreate with: %s', name, indexdef)
+                cursor.execute('DROP INDEX %s' % name)
+            cursor.execute('ALTER TABLE %s DISABLE TRIGGER USER' % table)
+        try:
+            yield
+        finally:
+            errors = []
+            with conn.cursor() as cursor:
+                for name, indexdef in indexes:
+                    try:
+                        cursor.execute(indexdef)
+                    except Exception as e:
+                        logger.error('recreate index %s failed, run it by hand: %s', name, indexdef)
+                        errors.append(e)
+                cursor.execute('ALTER TABLE %s ENABLE TRIGGER USER' % table)
+            if errors:
+                raise errors[0]
+
+    def _bulk_insert_cursor(self, rows):
+        """
+        把 build_row 生成的行直接用游标 INSERT，不经过 bulk_create。
+        psycopg2 用 execute_values 拼成一条多行 VALUES，其他驱动用 executemany。
+        """
+        conn = connections[self.dest_db]
+        i = self._insert_pk_index
+        if i is None:
+            groups = ((True, rows),)
+        else:
+            groups = ((True, [row for row in rows if row[i] is not None]),
+                      (False, [row[:i] + row[i + 1:] for row in rows if row[i] is None]))
+        with conn.cursor() as cursor:
+            for has_pk, batch in groups:
+                if not batch:
+                    continue
+                fields, sql = self._insert_sql[has_pk]
+                preps = [f.get_db_prep_save for f in fields]
+                params = [[prep(v, connection=conn) for prep, v in zip(preps, row)] for row in batch]
+                if execute_values is not None and type(cursor.cursor).__module__.startswith('psycopg2'):
+                    execute_values(cursor.cursor, sql + ' VALUES %s', params, page_size=len(params))
+                else:
+                    cursor.executemany('%s VALUES (%s)' % (sql, ', '.join(['%s'] * len(fields))), params)
+
+    def _copy_supported(self):
+        """
+        psycopg 3 的 write_row 自己适配所有类型；psycopg2 走 _copy_text，只支持 _COPY_TEXT_TYPES 中的字段
+        """
+        try:
+            from django.db.backends.postgresql.psycopg_any import is_psycopg3
+        except ImportError:
+            is_psycopg3 = False
+        if is_psycopg3:
+            return True
+        for f in self.dest._meta.local_concrete_fields:
+            field = f.target_field if f.is_relation else f
+            if field.get_internal_type() not in _COPY_TEXT_TYPES:
+                return False
+        return True
+
+    def _save(self, buffer, bulk_kwargs, dry_run=False, transaction_per_batch=True, writer='orm'):
+        """
+        写入一批数据，默认每批单独一个事务提交。
+        :param bulk_kwargs: keyword arguments for bulk_create
+        :param writer: 'orm' (bulk_create), 'copy' or 'cursor'
+        """
+        if dry_run:
+            return
+        with self._atomic(transaction_per_batch):
+            if writer == 'copy':
+                self._copy(buffer)
+            elif writer == 'cursor':
+                self._bulk_insert_cursor(buffer)
+            else:
+                self.dest.objects.bulk_create(buffer, **bulk_kwargs)
+
+    def _report_progress(self, final=False):
+        # redraw at most every PROGRESS_INTERVAL seconds, and only on a terminal
+        if not sys.stdout.isatty():
+            return
+        now = time.monotonic()
+        if not final and now - self._last_progress_ts < self.PROGRESS_INTERVAL:
             return
-        buffer = []
-        qs = self.source_qs
-        for old_obj in qs:
+        self._last_progress_ts = now
+        progress(self.succeed_cnt, self.total_cnt,
+                 status='migrating from %s to %s(%s/%s)' %
+                        (self.source._meta.object_name, self.dest._meta.object_name, self.succeed_cnt,
+                         '?' if self.total_cnt is None else self.total_cnt)
+        )
+
+    def _auto_batch_size(self):
+        """
+        根据目标库的参数个数上限和目标表字段数估算 batch_size，保证一条 INSERT 不超限
+        """
+        conn = connections[self.dest_db]
+        vendor_cap = self.VENDOR_BATCH_SIZE.get(conn.vendor, 5000)
+        max_params = conn.features.max_query_params
+        if not max_params:
+            return vendor_cap
+        return max(1, min(max_params // len(self.dest._meta.concrete_fields), vendor_cap))
+
+    def _build_objs(self, rows, skip, build_obj, keep_source=False):
+        """
+        逐行 build_obj，skip 为 True 时跳过出错的行
+        :param keep_source: yield (old_obj, obj) pairs instead of obj
+        """
+        for old_obj in rows:
             try:
-                obj = self.build_obj(old_obj)
+                obj = build_obj(old_obj)
             except Exception as e:
                 logger.warning('skip obj %s due to %s', old_obj, str(e))
                 if skip:
                     continue
                 else:
                     raise
+            yield (old_obj, obj) if keep_source else obj
 
-            buffer.append(obj)
-            if len(buffer) >= batch_size:
-                if not dry_run:
-                    created = self.dest.objects.bulk_create(buffer, batch_size=batch_size)
-                else:
-                    created = buffer
-                self.succeed_cnt += len(created)
-                buffer.clear()
-                progress(
-                    self.succeed_cnt, self.total_cnt,
-                    status='migrating from %s to %s(%s/%s)' %
-                           (self.source._meta.object_name, self.dest._meta.object_name, self.succeed_cnt, self.total_cnt)
-                )
-
-        if len(buffer):
-            if not dry_run:
-                created = self.dest.objects.bulk_create(buffer, batch_size=batch_size)
+    def _apply_vectorized(self, pairs, writer, skip):
+        """
+        按列计算一批数据的 vectorized_mapping 字段。整列出错或源值不是数值（object 数组，
+        比如含 None）时改为逐行计算，skip 为 True 时跳过出错的行
+        :param pairs: (old_obj, obj) list, obj is a row tuple when writer is 'cursor'
+        :return: list of obj
+        """
+        for field, (source_attr, func) in self._vectorized.items():
+            getter = operator.attrgetter(source_attr)
+            raw = [getter(old) for old, obj in pairs]
+            values = np.asarray(raw)
+            column = None
+            if values.dtype != object:
+                try:
+                    column = self._vectorized_column(field, func, values)
+                except Exception as e:
+                    if not skip:
+                        raise
+                    logger.warning('vectorized_mapping for %s failed on the batch (%s), retrying row by row.',
+                                   field, str(e))
+            if column is None:
+                kept, column = [], []
+                for pair, value in zip(pairs, raw):
+                    try:
+                        column.extend(self._vectorized_column(field, func, np.asarray([value])))
+                    except Exception as e:
+                        logger.warning('skip obj %s due to %s', pair[0], str(e))
+                        if skip:
+                            continue
+                        raise
+                    kept.append(pair)
+                pairs = kept
+            if field in self.defaults:
+                default = self.defaults[field]
+                column = [v or default for v in column]
+            if writer == 'cursor':
+                i = [f.attname for f in self._insert_fields].index(field)
+                pairs = [(old, row[:i] + (v,) + row[i + 1:]) for (old, row), v in zip(pairs, column)]
             else:
-                created = buffer
-            self.succeed_cnt += len(created)
-            buffer.clear()
-        progress(self.succeed_cnt, self.total_cnt,
-                 status='migrating from %s to %s(%s/%s)' %
-                        (self.source._meta.object_name, self.dest._meta.object_name, self.succeed_cnt, self.total_cnt)
-        )
+                for (old, obj), v in zip(pairs, column):
+                    setattr(obj, field, v)
+        return [obj for old, obj in pairs]
+
+    def _vectorized_column(self, field, func, values):
+        column = func(values)
+        if len(column) != len(values):
+            raise ValueError('vectorized_mapping for %s returned %s values for %s rows.'
+                             % (field, len(column), len(values)))
+        # back to python scalars, database adapters do not know numpy types
+        return np.asarray(column).tolist()
+
+    def _migrate(self, qs, batch_size, bulk_kwargs, dry_run, skip, transaction_per_batch, writer):
+        """
+        迁移 qs 中的数据
+        """
+        build = self.build_row if writer == 'cursor' else self.build_obj
+        vectorized = bool(self._vectorized)
+        objs = self._build_objs(self.iter_source(self.source_chunk_size or batch_size, qs), skip, build, vectorized)
+        while True:
+            batch = list(islice(objs, batch_size))
+            if not batch:
+                break
+            if vectorized:
+                batch = self._apply_vectorized(batch, writer, skip)
+                if not batch:
+                    continue
+            self._save(batch, bulk_kwargs, dry_run, transaction_per_batch, writer)
+            with self._cnt_lock:
+                self.succeed_cnt += len(batch)
+            self._report_progress()
+
+    def _migrate_range(self, lo, hi, batch_size, bulk_kwargs, dry_run, skip, writer):
+        # runs in a worker thread, django gives each thread its own connections
+        try:
+            self._migrate(self.source_qs.filter(pk__gte=lo, pk__lt=hi),
+                          batch_size, bulk_kwargs, dry_run, skip, True, writer)
+        finally:
+            connections.close_all()
+
+    def run(self, batch_size=None, check_foreignkey=True, stop_on_error=True, dry_run=False, skip=True,
+            transaction_per_batch=True, use_copy=False, workers=1, ignore_conflicts=None,
+            update_conflicts=False, update_fields=None, unique_fields=None, use_cursor=False, show_total=True,
+            rebuild_indexes=False):
+        """
+        :param batch_size: integer bulk size. Defaults to the largest size the
+            destination backend accepts in one INSERT, see _auto_batch_size.
+        :param check_foreignkey: A boolean flag.
+        :param stop_on_error: A boolean flag.
+        :param transaction_per_batch: commit after every batch. Pass False to
+            run the whole migration in one transaction.
+        :param use_copy: write with COPY FROM STDIN instead of bulk_create.
+            PostgreSQL only, other backends fall back to bulk_create. With
+            psycopg2 it also falls back when dest has fields such as arrays,
+            hstore, ranges or durations.
+        :param workers: split the source into this many pk ranges and migrate
+            them in parallel threads. Needs an integer source pk.
+        :param ignore_conflicts: passed to bulk_create so rows violating a unique
+            constraint are dropped by the database instead of failing the batch.
+            Defaults to the value of skip when the dest backend supports it
+            (False when use_copy or use_cursor is on). succeed_cnt then counts
+            rows sent, not rows inserted.
+        :param update_conflicts: update_fields, unique_fields: passed to
+            bulk_create to upsert conflicting rows instead (Django 4.1+).
+        :param use_cursor: build plain row tuples instead of dest instances and
+            INSERT them on the cursor (execute_values on psycopg2, executemany
+            elsewhere). Falls back to bulk_create when dest has auto_now or file
+            fields, pre_init/post_init receivers, or mapping keys that are not fields.
+        :param show_total: count the source rows in a background thread so the
+            progress bar can show a percentage. With False only the number of
+            migrated rows is shown and no COUNT(*) is run.
+        :param rebuild_indexes: PostgreSQL only. Drop the non-unique indexes of
+            dest and disable its user triggers while migrating, recreate/enable
+            them afterwards. dest is partly unindexed and triggers do not fire
+            during the run, so only use it when nothing else uses the table.
+        :return:
+        """
+        # TODO check_foreignkey
+        # TODO stop_on_error
+
+        if batch_size is None:
+            batch_size = self._auto_batch_size()
+        writer = 'orm'
+        if use_copy:
+            if connections[self.dest_db].vendor != 'postgresql':
+                logger.warning('use_copy is only supported on postgresql, fall back to bulk_create.')
+            elif not self._copy_supported():
+                logger.warning('%s has fields COPY text format can not encode with psycopg2, '
+                               'fall back to bulk_create.', self.dest._meta.label)
+            else:
+                writer = 'copy'
+        elif use_cursor:
+            if self.build_row is not None:
+                writer = 'cursor'
+            else:
+                logger.warning('use_cursor is not possible for %s, fall back to bulk_create.', self.dest._meta.label)
+        if update_conflicts:
+            ignore_conflicts = False
+        elif ignore_conflicts is None:
+            ignore_conflicts = (skip and writer == 'orm'
+                                and connections[self.dest_db].features.supports_ignore_conflicts)
+        if writer != 'orm' and (ignore_conflicts or update_conflicts):
+            logger.warning('%s can not handle conflicts, fall back to bulk_create.', writer)
+            writer = 'orm'
+
+        bulk_kwargs = {'batch_size': batch_size}
+        if ignore_conflicts:
+            bulk_kwargs['ignore_conflicts'] = True
+        if update_conflicts:
+            bulk_kwargs.update(update_conflicts=True, update_fields=update_fields, unique_fields=unique_fields)
+
+        if workers > 1:
+            if not transaction_per_batch:
+                raise ValueError('workers > 1 requires transaction_per_batch=True.')
+            if not _has_integer_pk(self.source):
+                raise ValueError('workers > 1 requires an integer pk on %s.' % self.source._meta.object_name)
+
+        if show_total:
+            self._count_async()
+        with self._relax_destination(rebuild_indexes and not dry_run):
+            if workers > 1:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = [
+                        executor.submit(self._migrate_range, lo, hi, batch_size, bulk_kwargs, dry_run, skip, writer)
+                        for lo, hi in self._pk_ranges(workers)
+                    ]
+                    for future in futures:
+                        future.result()
+            else:
+                with self._atomic(not transaction_per_batch):
+                    self._migrate(self.source_qs, batch_size, bulk_kwargs, dry_run, skip, transaction_per_batch,
+                                  writer)
+        if self._count_thread is not None:
+            self._count_thread.join(self.COUNT_WAIT)
+        self._report_progress(final=True)
+
+        total = '?' if self.total_cnt is None else self.total_cnt
+        if ignore_conflicts and not dry_run:
+            # the database drops conflicting rows silently, succeed_cnt only counts rows sent
+            result = 'attempted (conflicting rows ignored, inserted count unknown)'
+        else:
+            result = 'succeed'
+        print('\n\nmigrate to %s finished: %s of %s %s.' %
+              (self.source._meta.object_name, self.succeed_cnt, total, result))
+        logger.info('\n\nmigrate to %s finished: %s of %s %s.',
+                    self.source._meta.object_name, self.succeed_cnt, total, result)
+
+
+_worker_tubes = None
+
 
-        print('\n\nmigrate to %s finished: %s of %s succeed.' %
-              (self.source._meta.object_name, self.succeed_cnt, self.total_cnt))
-        logger.info('\n\nmigrate to %s finished: %s of %s succeed.',
-                    self.source._meta.object_name, self.succeed_cnt, self.total_cnt)
+def _init_tube_worker(tubes):
+    global _worker_tubes
+    _worker_tubes = tubes
+    # never reuse connections inherited from the parent process
+    connections.close_all()
+
+
+def _run_tube_worker(index, kwargs):
+    tube = _worker_tubes[index]
+    tube.run(**kwargs)
+    return tube.succeed_cnt
 
 
 class TubeSet(object):
@@ -212,20 +822,84 @@ class TubeSet(object):
         https://stackoverflow.com/questions/14589634/how-to-reset-the-sequence-for-ids-on-postgresql-tables
         :return: sequence val
         """
-        models = [tube.dest for tube in self._tubes]
+        models = list(dict.fromkeys(tube.dest for tube in self._tubes))
         sequence_sql = connection.ops.sequence_reset_sql(no_style(), models)
-        with connection.cursor() as cursor:
-            for sql in sequence_sql:
-                cursor.execute(sql)
+        if sequence_sql:
+            with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+                if connection.vendor == 'postgresql':
+                    # postgresql runs several statements in one execute, one round-trip for all tables
+                    cursor.execute('\n'.join(sql if sql.endswith(';') else sql + ';' for sql in sequence_sql))
+                else:
+                    for sql in sequence_sql:
+                        cursor.execute(sql)
         print('reset sequence finished for ', models)
 
-    def run(self, **kwargs):
+    def _fk_deps(self):
+        """
+        tube A 的 dest 有外键指向 tube B 的 dest 时，A 依赖 B。
+        :return: {tube index: set of tube indexes it depends on}
+        """
+        writers = {}
+        for i, tube in enumerate(self._tubes):
+            writers.setdefault(tube.dest, set()).add(i)
+        deps = {}
+        for i, tube in enumerate(self._tubes):
+            deps[i] = set()
+            for field in tube.dest._meta.concrete_fields:
+                if field.is_relation and field.remote_field.model is not tube.dest:
+                    deps[i] |= writers.get(field.remote_field.model, set())
+        return deps
+
+    def _levels(self):
+        """
+        按外键依赖拓扑排序分层，同一层内的 tube 互不依赖，可以并行。
+        """
+        deps = self._fk_deps()
+        done = set()
+        levels = []
+        while len(done) < len(deps):
+            level = [i for i in sorted(deps) if i not in done and deps[i] <= done]
+            if not level:
+                # circular foreign keys, run the rest one by one in the original order
+                rest = [i for i in sorted(deps) if i not in done]
+                logger.warning('circular foreign keys between tubes %s, run them sequentially.', rest)
+                levels.extend([i] for i in rest)
+                break
+            levels.append(level)
+            done.update(level)
+        return levels
+
+    def _run_parallel(self, parallel_tubes, kwargs):
+        # workers are forked and must open their own connections
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=parallel_tubes, mp_context=multiprocessing.get_context('fork'),
+                                 initializer=_init_tube_worker, initargs=(self._tubes,)) as executor:
+            for level in self._levels():
+                futures = {i: executor.submit(_run_tube_worker, i, kwargs) for i in level}
+                for i, future in futures.items():
+                    self._tubes[i].succeed_cnt = future.result()
+
+    def run(self, parallel_tubes=1, **kwargs):
+        """
+        :param parallel_tubes: run up to this many tubes at once in worker
+            processes. Tubes whose dest has a foreign key to another tube's dest
+            wait for that tube to finish. Needs the fork start method, falls
+            back to running sequentially where it is not available.
+        :param kwargs: passed to SuperTube.run
+        """
         if 'dry_run' in kwargs and kwargs['dry_run']:
             print('*'*90+'\n'
             +'\nFBI Warning: Start run tubeset in dry-run mode, no data will be written to dest database.\n\n'
             +'*'*90+'\n')
-        for tube in self._tubes:
-            tube.run(**kwargs)
+        if parallel_tubes > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+            # workers inherit the tubes by fork, other start methods would have to pickle them
+            logger.warning('fork start method is not available on this platform, running tubes sequentially.')
+            parallel_tubes = 1
+        if parallel_tubes > 1:
+            self._run_parallel(parallel_tubes, kwargs)
+        else:
+            for tube in self._tubes:
+                tube.run(**kwargs)
         print('reset sequence start.')
         self.update_sequence()
 